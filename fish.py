@@ -55,7 +55,7 @@ import struct
 import hashlib
 import base64
 import sys
-from os import urandom
+import secrets
 
 SCRIPT_NAME = "fish"
 SCRIPT_AUTHOR = "David Flatz <david@upcs.at>"
@@ -79,8 +79,44 @@ except ImportError:
     try:
         import Cryptodome.Cipher.Blowfish as CryptoBlowfish
     except ImportError:
-        print("Pycryptodome must be installed to use fish")
-        import_ok = False
+        CryptoBlowfish = None
+
+try:
+    from cryptography.exceptions import UnsupportedAlgorithm
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives.ciphers import Cipher, modes
+    try:
+        from cryptography.hazmat.decrepit.ciphers.algorithms import (
+                Blowfish as CryptographyBlowfish)
+    except ImportError:
+        from cryptography.hazmat.primitives.ciphers.algorithms import (
+                Blowfish as CryptographyBlowfish)
+    # cryptography < 3.1 requires the backend argument, later versions
+    # ignore it.
+    cryptography_backend = default_backend()
+except ImportError:
+    CryptographyBlowfish = None
+else:
+    # OpenSSL 3 only has Blowfish in the legacy provider, which may not be
+    # loaded.  Fall back to pycryptodome then.
+    try:
+        Cipher(CryptographyBlowfish(b"\0" * 8), modes.ECB(),
+               cryptography_backend).encryptor()
+    except UnsupportedAlgorithm:
+        CryptographyBlowfish = None
+
+if CryptoBlowfish is None and CryptographyBlowfish is None:
+    print("Pycryptodome or cryptography with Blowfish support must be "
+          "installed to use fish")
+    import_ok = False
+
+try:
+    from Crypto.Math.Numbers import Integer
+except ImportError:
+    try:
+        from Cryptodome.Math.Numbers import Integer
+    except ImportError:
+        Integer = None
 
 
 #
@@ -91,10 +127,13 @@ fish_config_file = None
 fish_config_section = {}
 fish_config_option = {}
 fish_keys = {}
+fish_keys_evaluated = {}
 fish_cbc = {}
+fish_keys_encoded = {}
 fish_cyphers = {}
 fish_DH1080ctx = {}
 fish_encryption_announced = {}
+fish_announce_enabled = True
 
 
 #
@@ -120,6 +159,7 @@ def fish_config_keys_read_cb(data, config_file, section_name, option_name,
         value = value[4:]
 
     fish_keys[option_name] = value
+    fish_forget_key(option_name)
 
     return weechat.WEECHAT_CONFIG_OPTION_SET_OK_CHANGED
 
@@ -136,6 +176,12 @@ def fish_config_keys_write_cb(data, config_file, section_name):
     return weechat.WEECHAT_RC_OK
 
 
+def fish_config_announce_change_cb(data, option):
+    global fish_announce_enabled
+
+    fish_announce_enabled = bool(weechat.config_boolean(option))
+
+
 def fish_config_init():
     global fish_config_file, fish_config_section, fish_config_option
 
@@ -155,7 +201,8 @@ def fish_config_init():
     fish_config_option["announce"] = weechat.config_new_option(
             fish_config_file, fish_config_section["look"], "announce",
             "boolean", "announce if messages are being encrypted or not", "",
-            0, 0, "on", "on", 0, "", "", "", "", "", "")
+            0, 0, "on", "on", 0, "", "", "fish_config_announce_change_cb", "",
+            "", "")
     fish_config_option["marker"] = weechat.config_new_option(
             fish_config_file, fish_config_section["look"], "marker",
             "string", "marker for important FiSH messages", "", 0, 0,
@@ -184,9 +231,15 @@ def fish_config_init():
 
 
 def fish_config_read():
-    global fish_config_file
+    global fish_config_file, fish_config_option
 
-    return weechat.config_read(fish_config_file)
+    rc = weechat.config_read(fish_config_file)
+    # The option is missing if fish_config_init() bailed out early.
+    announce = fish_config_option.get("announce")
+    if announce:
+        fish_config_announce_change_cb("", announce)
+
+    return rc
 
 
 def fish_config_write():
@@ -202,54 +255,108 @@ def fish_config_write():
 # BLOWFISH
 #
 
-class Blowfish:
+class _BlowfishECB:
+    """Blowfish in ECB mode using the cryptography package (OpenSSL)."""
 
-    def __init__(self, key=None):
-        if key:
-            if len(key) > 72:
-                key = key[:72]
-            self.blowfish = CryptoBlowfish.new(
-                    key.encode('utf-8'), CryptoBlowfish.MODE_ECB)
+    def __init__(self, key):
+        cipher = Cipher(
+                CryptographyBlowfish(key), modes.ECB(), cryptography_backend)
+        # ECB keeps no state between blocks, so one encryptor/decryptor pair
+        # can be reused for every message as long as it is never finalized.
+        # update() would silently hold back a partial block and mix it into
+        # the next message, so unaligned data is rejected like pycryptodome
+        # does.
+        self._encrypt = cipher.encryptor().update
+        self._decrypt = cipher.decryptor().update
 
     def decrypt(self, data):
-        return self.blowfish.decrypt(data)
+        if len(data) % 8:
+            raise ValueError("Data must be aligned to block boundary")
+        return self._decrypt(data)
 
     def encrypt(self, data):
-        return self.blowfish.encrypt(data)
+        if len(data) % 8:
+            raise ValueError("Data must be aligned to block boundary")
+        return self._encrypt(data)
+
+
+def _blowfish_cbc_encrypt(key, iv, data):
+    """Encrypts 'data' in CBC mode; a new cipher is needed per message."""
+    if CryptographyBlowfish is not None:
+        encryptor = Cipher(
+                CryptographyBlowfish(key), modes.CBC(iv),
+                cryptography_backend).encryptor()
+        return encryptor.update(data) + encryptor.finalize()
+    return CryptoBlowfish.new(key, CryptoBlowfish.MODE_CBC, iv).encrypt(data)
+
+
+def _blowfish_cbc_decrypt(key, iv, data):
+    """Decrypts 'data' in CBC mode."""
+    if CryptographyBlowfish is not None:
+        decryptor = Cipher(
+                CryptographyBlowfish(key), modes.CBC(iv),
+                cryptography_backend).decryptor()
+        return decryptor.update(data) + decryptor.finalize()
+    return CryptoBlowfish.new(key, CryptoBlowfish.MODE_CBC, iv).decrypt(data)
+
+
+def Blowfish(key):
+    """Returns the ECB cipher for 'key'; callers use its encrypt and
+    decrypt methods directly.  The key schedule is expensive, so callers
+    keep the cipher in fish_cyphers."""
+    key = key[:72].encode('utf-8')
+    if CryptographyBlowfish is not None:
+        return _BlowfishECB(key)
+    return CryptoBlowfish.new(key, CryptoBlowfish.MODE_ECB)
+
+
+# Big endian (left, right) word pair of a Blowfish block.
+_BLOWCRYPT_BLOCK = struct.Struct('>LL')
+# The twelve digits of an encoded block, right word first.
+_BLOWCRYPT_DIGITS = struct.Struct('12B')
+_BLOWCRYPT_B64 = (
+        b"./0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ")
+# Two output characters for each 12-bit value, least significant six bits
+# first, so a 32-bit word encodes with three lookups instead of six.
+_BLOWCRYPT_B64_ENC12 = tuple(
+        bytes((_BLOWCRYPT_B64[v & 0x3f], _BLOWCRYPT_B64[v >> 6]))
+        for v in range(4096))
+# Digit value of each byte, 0xff for bytes outside the alphabet.
+_BLOWCRYPT_B64_DEC = bytes(
+        _BLOWCRYPT_B64.find(c) & 0xff for c in range(256))
 
 
 # XXX: Unstable.
 def blowcrypt_b64encode(s):
     """A non-standard base64-encode."""
-    B64 = "./0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
-    res = ''
-    while s:
-        left, right = struct.unpack('>LL', s[:8])
-        for i in range(6):
-            res += B64[right & 0x3f]
-            right >>= 6
-        for i in range(6):
-            res += B64[left & 0x3f]
-            left >>= 6
-        s = s[8:]
-    return res
+    enc = _BLOWCRYPT_B64_ENC12
+    res = bytearray()
+    for left, right in _BLOWCRYPT_BLOCK.iter_unpack(s):
+        res += enc[right & 0xfff]
+        res += enc[(right >> 12) & 0xfff]
+        res += enc[right >> 24]
+        res += enc[left & 0xfff]
+        res += enc[(left >> 12) & 0xfff]
+        res += enc[left >> 24]
+    return res.decode('ascii')
 
 
 def blowcrypt_b64decode(s):
     """A non-standard base64-decode."""
-    B64 = "./0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
-    res = []
-    while s:
-        left, right = 0, 0
-        for i, p in enumerate(s[0:6]):
-            right |= B64.index(p) << (i * 6)
-        for i, p in enumerate(s[6:12]):
-            left |= B64.index(p) << (i * 6)
-        for i in range(0, 4):
-            res.append((left & (0xFF << ((3 - i) * 8))) >> ((3 - i) * 8))
-        for i in range(0, 4):
-            res.append((right & (0xFF << ((3 - i) * 8))) >> ((3 - i) * 8))
-        s = s[12:]
+    # A partial last block, e.g. of a line cut short by the server, cannot
+    # be decrypted and is dropped.
+    digits = s[:len(s) - len(s) % 12].encode().translate(_BLOWCRYPT_B64_DEC)
+    if b'\xff' in digits:
+        raise ValueError
+    res = bytearray()
+    pack = _BLOWCRYPT_BLOCK.pack
+    for (r0, r1, r2, r3, r4, r5,
+         l0, l1, l2, l3, l4, l5) in _BLOWCRYPT_DIGITS.iter_unpack(digits):
+        res += pack(
+                (l0 | l1 << 6 | l2 << 12 | l3 << 18 | l4 << 24 | l5 << 30)
+                & 0xffffffff,
+                (r0 | r1 << 6 | r2 << 12 | r3 << 18 | r4 << 24 | r5 << 30)
+                & 0xffffffff)
     return bytes(res)
 
 
@@ -257,27 +364,37 @@ def padto(msg, length):
     """Pads 'msg' with zeroes until it's length is divisible by 'length'.
     If the length of msg is already a multiple of 'length', does nothing."""
     L = len(msg)
-    if L % length:
-        msg += b'\x00' * (length - L % length)
-    assert len(msg) % length == 0
-    return msg
+    if not L % length:
+        return msg
+    # The ciphers take any buffer, so fill a zeroed one of the final size
+    # instead of concatenating a separate run of zeroes.
+    padded = bytearray(L + length - L % length)
+    padded[:L] = msg
+    return padded
 
 
 def blowcrypt_pack(msg, cipher, cbcKey=None):
-    """."""
+    """'cbcKey' is the encoded key for CBC mode, None for ECB."""
     if cbcKey is not None: # CBC mode
-        cbcCipher = CryptoBlowfish.new(
-                cbcKey.encode('utf-8'), CryptoBlowfish.MODE_CBC)
-        return '+OK *'+ base64.b64encode(cbcCipher.iv + cbcCipher.encrypt(padto(msg, 8))).decode('utf-8')
+        iv = secrets.token_bytes(8)
+        return '+OK *' + base64.b64encode(
+                iv + _blowfish_cbc_encrypt(cbcKey, iv, padto(msg, 8))
+                ).decode('ascii')
     else:
         return '+OK ' + blowcrypt_b64encode(cipher.encrypt(padto(msg, 8)))
 
 
+_CIPHERTEXT_PREFIXES = ('+OK ', 'mcps ')
+
+
 def blowcrypt_unpack(msg, cipher, key):
-    """."""
-    if not (msg.startswith('+OK ') or msg.startswith('mcps ')):
+    """'key' is the encoded key, used if 'msg' is in CBC mode."""
+    for prefix in _CIPHERTEXT_PREFIXES:
+        if msg.startswith(prefix):
+            rest = msg[len(prefix):]
+            break
+    else:
         raise ValueError
-    _, rest = msg.split(' ', 1)
 
     if rest.startswith('*'):  # CBC mode
         rest = rest[1:]
@@ -288,21 +405,15 @@ def blowcrypt_unpack(msg, cipher, key):
         iv = raw[:8]
         raw = raw[8:]
 
-        cbcCipher = CryptoBlowfish.new(
-                key.encode('utf-8'), CryptoBlowfish.MODE_CBC, iv)
-
-        plain = cbcCipher.decrypt(padto(raw, 8))
+        plain = _blowfish_cbc_decrypt(key, iv, padto(raw, 8))
 
     else:
 
         if len(rest) < 12:
             raise ValueError
 
-        if not (len(rest) % 12) == 0:
-            rest = rest[:-(len(rest) % 12)]
-
         try:
-            raw = blowcrypt_b64decode(padto(rest, 12))
+            raw = blowcrypt_b64decode(rest)
         except TypeError:
             raise ValueError
         if not raw:
@@ -330,105 +441,53 @@ p_dh1080 = int('FBE1022E23D213E8ACFA9AE8B9DFAD'
 q_dh1080 = (p_dh1080 - 1) // 2
 
 
+_DH1080_B64 = (
+        b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/")
+# The reference decoder reads bytes outside the alphabet as zero digits.
+_DH1080_B64_CLEAN = bytes(
+        c if c in _DH1080_B64 else ord('A') for c in range(256))
+
+
 def dh1080_b64encode(s):
     """A non-standard base64-encode."""
-    b64 = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/"
-    d = [0] * len(s) * 2
-
-    L = len(s) * 8
-    m = 0x80
-    i, j, k, t = 0, 0, 0, 0
-    while i < L:
-        if s[i >> 3] & m:
-            t |= 1
-        j += 1
-        m >>= 1
-        if not m:
-            m = 0x80
-        if not j % 6:
-            d[k] = b64[t]
-            t &= 0
-            k += 1
-        t <<= 1
-        t %= 0x100
-        #
-        i += 1
-    m = 5 - j % 6
-    t <<= m
-    t %= 0x100
-    if m:
-        d[k] = b64[t]
-        k += 1
-    d[k] = 0
-    res = ''
-    for q in d:
-        if q == 0:
-            break
-        res += q
+    res = base64.b64encode(s).rstrip(b'=').decode('ascii')
+    # FiSH emits one more zero digit when there are no padding bits.
+    if len(s) % 3 == 0:
+        res += 'A'
     return res
 
 
 def dh1080_b64decode(s):
-    """A non-standard base64-encode."""
-    b64 = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/"
-    buf = [0] * 256
-    for i in range(64):
-        buf[ord(b64[i])] = i
+    """A non-standard base64-decode."""
+    s = s.encode('latin-1').translate(_DH1080_B64_CLEAN)
 
     L = len(s)
     if L < 2:
         raise ValueError
-    for i in reversed(list(range(L - 1))):
-        if buf[ord(s[i])] == 0:
-            L -= 1
-        else:
-            break
+    # Drop as many characters from the end as there are zero digits in
+    # front of the last one, like the reference implementation does.
+    L -= len(s) - 1 - len(s[:-1].rstrip(b'A'))
     if L < 2:
         raise ValueError
 
-    d = [0] * L
-    i, k = 0, 0
-    while True:
-        i += 1
-        if k + 1 < L:
-            d[i - 1] = buf[ord(s[k])] << 2
-            d[i - 1] %= 0x100
-        else:
-            break
-        k += 1
-        if k < L:
-            d[i - 1] |= buf[ord(s[k])] >> 4
-        else:
-            break
-        i += 1
-        if k + 1 < L:
-            d[i - 1] = buf[ord(s[k])] << 4
-            d[i - 1] %= 0x100
-        else:
-            break
-        k += 1
-        if k < L:
-            d[i - 1] |= buf[ord(s[k])] >> 2
-        else:
-            break
-        i += 1
-        if k + 1 < L:
-            d[i - 1] = buf[ord(s[k])] << 6
-            d[i - 1] %= 0x100
-        else:
-            break
-        k += 1
-        if k < L:
-            d[i - 1] |= buf[ord(s[k])] % 0x100
-        else:
-            break
-        k += 1
-    return bytes(d[0:i - 1])
+    # A single trailing digit does not complete a byte.
+    s = s[:L - 1] if L % 4 == 1 else s[:L]
+    return base64.b64decode(s + b'=' * (-len(s) % 4))
+
+
+if Integer is not None:
+    # Converted once; every exchange uses the same modulus.
+    _p_dh1080_integer = Integer(p_dh1080)
 
 
-def dh_validate_public(public, q, p):
-    """See RFC 2631 section 2.1.5."""
-    return 1 == pow(public, q, p)
+def _dh1080_modexp(g, x, p):
+    """Computes g**x mod p, using pycryptodome's GMP/Montgomery code if it is
+    available and falling back to the builtin pow() otherwise."""
+    if Integer is None:
+        return pow(g, x, p)
+    if p == p_dh1080:
+        p = _p_dh1080_integer
+    return int(pow(Integer(g), x, p))
 
 
 class DH1080Ctx:
@@ -442,10 +501,13 @@ class DH1080Ctx:
 
         bits = 1080
         while True:
-            self.private = bytes2int(urandom(bits // 8))
-            self.public = pow(g_dh1080, self.private, p_dh1080)
-            if 2 <= self.public <= p_dh1080 - 1 and \
-               dh_validate_public(self.public, q_dh1080, p_dh1080) == 1:
+            # 2 is a quadratic non-residue mod p, so g**x lies in the
+            # subgroup of order q (the public key check of RFC 2631
+            # section 2.1.5) exactly when x is even.  Clearing the low bit
+            # keeps every key in that subgroup without checking or retrying.
+            self.private = secrets.randbits(bits) & ~1
+            self.public = _dh1080_modexp(g_dh1080, self.private, p_dh1080)
+            if 2 <= self.public <= p_dh1080 - 1:
                 break
 
 
@@ -475,7 +537,7 @@ def dh1080_unpack(msg, ctx):
             if not 1 < public < p_dh1080:
                 raise ValueError
 
-            ctx.secret = pow(public, ctx.private, p_dh1080)
+            ctx.secret = _dh1080_modexp(public, ctx.private, p_dh1080)
             ctx.cbc = "CBC" in rest or cmd == "DH1080_INIT_CBC"
 
         except Exception:
@@ -492,7 +554,7 @@ def dh1080_unpack(msg, ctx):
             if not 1 < public < p_dh1080:
                 raise ValueError
 
-            ctx.secret = pow(public, ctx.private, p_dh1080)
+            ctx.secret = _dh1080_modexp(public, ctx.private, p_dh1080)
             ctx.cbc = "CBC" in rest
 
         except Exception:
@@ -510,22 +572,14 @@ def dh1080_secret(ctx):
 
 def bytes2int(b):
     """Variable length big endian to integer."""
-    n = 0
-    for p in b:
-        n *= 256
-        n += p
-    return n
+    return int.from_bytes(b, 'big')
 
 
 def int2bytes(n):
     """Integer to variable length big endian."""
     if n == 0:
         return b'\x00'
-    b = []
-    while n:
-        b.insert(0, n % 256)
-        n //= 256
-    return bytes(b)
+    return n.to_bytes((n.bit_length() + 7) // 8, 'big')
 
 
 def sha256(s):
@@ -540,35 +594,51 @@ def sha256(s):
 # HOOKS
 #
 
+_RE_IN_NOTICE = re.compile(
+        r"^((?:@[^ ]* )?:(.*?)!.*? NOTICE (.*?) :)"
+        r"((DH1080_INIT |DH1080_INIT_CBC |DH1080_FINISH |\+OK |mcps )?.*)$")
+_RE_IN_PRIVMSG = re.compile(
+        r"^((?:@[^ ]* )?:(.*?)!.*? PRIVMSG (.*?) :)(\x01ACTION )?"
+        r"((\+OK |mcps )?.*?)(\x01)?$")
+_RE_IN_TOPIC = re.compile(
+        r"^((?:@[^ ]* )?:.*?!.*? TOPIC (.*?) :)((\+OK |mcps )?.*)$")
+_RE_IN_332 = re.compile(
+        r"^((?:@[^ ]* )?:.*? 332 .*? (.*?) :)((\+OK |mcps )?.*)$")
+_RE_OUT_PRIVMSG = re.compile(r"^(PRIVMSG (.*?) :)(.*)$")
+_RE_OUT_TOPIC = re.compile(r"^(TOPIC (.*?) :)(.*)$")
+
+
 def fish_modifier_in_notice_cb(data, modifier, server_name, string):
     global fish_DH1080ctx, fish_keys, fish_cyphers, fish_cbc
 
     if type(string) is bytes:
         return string
 
-    match = re.match(
-        r"^((?:@[^ ]* )?:(.*?)!.*? NOTICE (.*?) :)"
-        r"((DH1080_INIT |DH1080_INIT_CBC |DH1080_FINISH |\+OK |mcps )?.*)$",
-        string)
-    # match.group(0): message
-    # match.group(1): msg without payload
-    # match.group(2): source
-    # match.group(3): target
-    # match.group(4): msg
-    # match.group(5): "DH1080_INIT "|"DH1080_INIT_CBC "|"DH1080_FINISH "|"+OK "|"mcps "
-    if not match or not match.group(5):
+    if ("DH1080_" not in string and "+OK " not in string and
+            "mcps " not in string):
+        return string
+
+    match = _RE_IN_NOTICE.match(string)
+    if not match:
+        return string
+    # prefix: msg without payload
+    # source, recipient: sender and target of the notice
+    # msg: payload
+    # cmd: "DH1080_INIT "|"DH1080_INIT_CBC "|"DH1080_FINISH "|"+OK "|"mcps "
+    prefix, source, recipient, msg, cmd = match.groups()
+    if not cmd:
         return string
 
-    if match.group(3) != weechat.info_get("irc_nick", server_name):
+    if recipient != weechat.info_get("irc_nick", server_name):
         return string
 
-    target = "%s/%s" % (server_name, match.group(2))
-    targetl = ("%s/%s" % (server_name, match.group(2))).lower()
-    buffer = weechat.info_get("irc_buffer", "%s,%s" % (
-            server_name, match.group(2)))
+    target = "%s/%s" % (server_name, source)
+    targetl = target.lower()
+
+    if cmd == "DH1080_FINISH " and targetl in fish_DH1080ctx:
+        buffer = fish_target_buffer(target)
 
-    if match.group(5) == "DH1080_FINISH " and targetl in fish_DH1080ctx:
-        if not dh1080_unpack(match.group(4), fish_DH1080ctx[targetl]):
+        if not dh1080_unpack(msg, fish_DH1080ctx[targetl]):
             fish_announce_unencrypted(buffer, target)
             return string
 
@@ -576,16 +646,16 @@ def fish_modifier_in_notice_cb(data, modifier, server_name, string):
 
         fish_keys[targetl] = dh1080_secret(fish_DH1080ctx[targetl])
         fish_cbc[targetl] = fish_DH1080ctx[targetl].cbc
-        if targetl in fish_cyphers:
-            del fish_cyphers[targetl]
+        fish_forget_key(targetl)
         del fish_DH1080ctx[targetl]
 
         return ""
 
-    if match.group(5) == "DH1080_INIT " or match.group(5) == "DH_1080_INIT_CBC ":
+    if cmd == "DH1080_INIT " or cmd == "DH_1080_INIT_CBC ":
+        buffer = fish_target_buffer(target)
         fish_DH1080ctx[targetl] = DH1080Ctx()
 
-        if not dh1080_unpack(match.group(4), fish_DH1080ctx[targetl]):
+        if not dh1080_unpack(msg, fish_DH1080ctx[targetl]):
             fish_announce_unencrypted(buffer, target)
             return string
 
@@ -594,265 +664,199 @@ def fish_modifier_in_notice_cb(data, modifier, server_name, string):
         fish_alert(buffer, "Key exchange initiated by %s. Key set." % target)
 
         weechat.command(buffer, "/mute notice -server %s %s %s" % (
-                server_name, match.group(2), reply))
+                server_name, source, reply))
 
         fish_keys[targetl] = dh1080_secret(fish_DH1080ctx[targetl])
         fish_cbc[targetl] = fish_DH1080ctx[targetl].cbc
-        if targetl in fish_cyphers:
-            del fish_cyphers[targetl]
+        fish_forget_key(targetl)
         del fish_DH1080ctx[targetl]
 
         return ""
 
-    if match.group(5) in ["+OK ", "mcps "]:
+    if cmd in _CIPHERTEXT_PREFIXES:
         if targetl not in fish_keys:
-            fish_announce_unencrypted(buffer, target)
+            fish_announce_unencrypted(None, target)
             return string
 
-        key = weechat.string_eval_expression(fish_keys[targetl], {}, {},{})
-
-        try:
-            if targetl not in fish_cyphers:
-                b = Blowfish(key)
-                fish_cyphers[targetl] = b
-            else:
-                b = fish_cyphers[targetl]
-
-            clean = blowcrypt_unpack(match.group(4), b, key)
+        clean = fish_decrypt(targetl, target, msg)
 
-            fish_announce_encrypted(buffer, target)
-
-            return b"%s%s" % (match.group(1).encode(), clean)
-        except Exception as e:
-            fish_announce_unencrypted(buffer, target)
+        return b"%s%s" % (prefix.encode(), clean)
 
-            raise e
-
-    fish_announce_unencrypted(buffer, target)
+    fish_announce_unencrypted(None, target)
 
     return string
 
 
 def fish_modifier_in_privmsg_cb(data, modifier, server_name, string):
-    global fish_keys, fish_cyphers
+    global fish_keys, fish_encryption_announced
 
     if type(string) is bytes:
         return string
 
-    match = re.match(
-        r"^((?:@[^ ]* )?:(.*?)!.*? PRIVMSG (.*?) :)(\x01ACTION )?"
-        r"((\+OK |mcps )?.*?)(\x01)?$",
-        string)
-    # match.group(0): message
-    # match.group(1): msg without payload
-    # match.group(2): source
-    # match.group(3): target
-    # match.group(4): action
-    # match.group(5): msg
-    # match.group(6): "+OK "|"mcps "
+    # Without a ciphertext marker the line can only matter for announcing
+    # that a conversation is no longer encrypted.
+    if (not fish_encryption_announced and
+            "+OK " not in string and "mcps " not in string):
+        return string
+
+    match = _RE_IN_PRIVMSG.match(string)
     if not match:
         return string
+    # prefix: msg without payload
+    # source, recipient: sender and target of the message
+    # action: "\x01ACTION " for CTCP actions
+    # msg: payload
+    # marker: "+OK "|"mcps "
+    prefix, source, recipient, action, msg, marker, _ = match.groups()
+
+    # Plain messages only matter if either side has been announced as
+    # encrypted, so skip asking WeeChat for our nick otherwise.
+    if (not marker and
+            "%s/%s" % (server_name, source)
+            not in fish_encryption_announced and
+            "%s/%s" % (server_name, recipient)
+            not in fish_encryption_announced):
+        return string
 
-    if match.group(3) == weechat.info_get("irc_nick", server_name):
-        dest = match.group(2)
+    if recipient == weechat.info_get("irc_nick", server_name):
+        dest = source
     else:
-        dest = match.group(3)
+        dest = recipient
     target = "%s/%s" % (server_name, dest)
-    targetl = ("%s/%s" % (server_name, dest)).lower()
-    buffer = weechat.info_get("irc_buffer", "%s,%s" % (server_name, dest))
+    targetl = target.lower()
 
-    if not match.group(6):
-        fish_announce_unencrypted(buffer, target)
+    if not marker:
+        fish_announce_unencrypted(None, target)
 
         return string
 
     if targetl not in fish_keys:
-        fish_announce_unencrypted(buffer, target)
+        fish_announce_unencrypted(None, target)
 
         return string
 
-    key = weechat.string_eval_expression(fish_keys[targetl], {}, {}, {})
-
-    try:
-        if targetl not in fish_cyphers:
-            b = Blowfish(key)
-            fish_cyphers[targetl] = b
-        else:
-            b = fish_cyphers[targetl]
-
-        clean = blowcrypt_unpack(match.group(5), b, key)
-
-        fish_announce_encrypted(buffer, target)
-
-        if not match.group(4):
-            return b'%s%s' % (match.group(1).encode(), clean)
-
-        return b"%s%s%s\x01" % (
-                match.group(1).encode(), match.group(4).encode(), clean)
+    clean = fish_decrypt(targetl, target, msg)
 
-    except Exception as e:
-        fish_announce_unencrypted(buffer, target)
+    if not action:
+        return b'%s%s' % (prefix.encode(), clean)
 
-        raise e
+    return b"%s\x01ACTION %s\x01" % (prefix.encode(), clean)
 
 
 def fish_modifier_in_topic_cb(data, modifier, server_name, string):
-    global fish_keys, fish_cyphers
+    global fish_keys, fish_encryption_announced
 
     if type(string) is bytes:
         return string
 
-    match = re.match(r"^((?:@[^ ]* )?:.*?!.*? TOPIC (.*?) :)((\+OK |mcps )?.*)$", string)
-    # match.group(0): message
-    # match.group(1): msg without payload
-    # match.group(2): channel
-    # match.group(3): topic
-    # match.group(4): "+OK "|"mcps "
-    if not match:
+    if (not fish_encryption_announced and
+            "+OK " not in string and "mcps " not in string):
         return string
 
-    target = "%s/%s" % (server_name, match.group(2))
-    targetl = ("%s/%s" % (server_name, match.group(2))).lower()
-    buffer = weechat.info_get("irc_buffer", "%s,%s" % (
-        server_name, match.group(2)))
-
-    if targetl not in fish_keys or not match.group(4):
-        fish_announce_unencrypted(buffer, target)
-
+    match = _RE_IN_TOPIC.match(string)
+    if not match:
         return string
+    # prefix: msg without payload
+    # channel: channel
+    # topic: topic
+    # marker: "+OK "|"mcps "
+    prefix, channel, topic, marker = match.groups()
 
-    key = weechat.string_eval_expression(fish_keys[targetl], {}, {}, {})
+    target = "%s/%s" % (server_name, channel)
+    targetl = target.lower()
 
-    try:
-        if targetl not in fish_cyphers:
-            b = Blowfish(key)
-            fish_cyphers[targetl] = b
-        else:
-            b = fish_cyphers[targetl]
+    if targetl not in fish_keys or not marker:
+        fish_announce_unencrypted(None, target)
 
-        clean = blowcrypt_unpack(match.group(3), b, key)
-
-        fish_announce_encrypted(buffer, target)
+        return string
 
-        return b"%s%s" % (match.group(1).encode(), clean)
-    except Exception as e:
-        fish_announce_unencrypted(buffer, target)
+    clean = fish_decrypt(targetl, target, topic)
 
-        raise e
+    return b"%s%s" % (prefix.encode(), clean)
 
 
 def fish_modifier_in_332_cb(data, modifier, server_name, string):
-    global fish_keys, fish_cyphers
+    global fish_keys, fish_encryption_announced
 
     if type(string) is bytes:
         return string
 
-    match = re.match(r"^((?:@[^ ]* )?:.*? 332 .*? (.*?) :)((\+OK |mcps )?.*)$", string)
-    if not match:
+    if (not fish_encryption_announced and
+            "+OK " not in string and "mcps " not in string):
         return string
 
-    target = "%s/%s" % (server_name, match.group(2))
-    targetl = ("%s/%s" % (server_name, match.group(2))).lower()
-    buffer = weechat.info_get("irc_buffer", "%s,%s" % (
-        server_name, match.group(2)))
-
-    if targetl not in fish_keys or not match.group(4):
-        fish_announce_unencrypted(buffer, target)
-
+    match = _RE_IN_332.match(string)
+    if not match:
         return string
+    prefix, channel, topic, marker = match.groups()
 
-    key = weechat.string_eval_expression(fish_keys[targetl], {}, {}, {})
+    target = "%s/%s" % (server_name, channel)
+    targetl = target.lower()
 
-    try:
-        if targetl not in fish_cyphers:
-            b = Blowfish(key)
-            fish_cyphers[targetl] = b
-        else:
-            b = fish_cyphers[targetl]
+    if targetl not in fish_keys or not marker:
+        fish_announce_unencrypted(None, target)
 
-        clean = blowcrypt_unpack(match.group(3), b, key)
-
-        fish_announce_encrypted(buffer, target)
+        return string
 
-        return b"%s%s" % (match.group(1).encode(), clean)
-    except Exception as e:
-        fish_announce_unencrypted(buffer, target)
+    clean = fish_decrypt(targetl, target, topic)
 
-        raise e
+    return b"%s%s" % (prefix.encode(), clean)
 
 
 def fish_modifier_out_privmsg_cb(data, modifier, server_name, string):
-    global fish_keys, fish_cyphers, fish_cbc
+    global fish_keys, fish_cbc
 
     if type(string) is bytes:
         return string
 
-    match = re.match(r"^(PRIVMSG (.*?) :)(.*)$", string)
+    match = _RE_OUT_PRIVMSG.match(string)
     if not match:
         return string
+    prefix, dest, msg = match.groups()
 
-    target = "%s/%s" % (server_name, match.group(2))
-    targetl = ("%s/%s" % (server_name, match.group(2))).lower()
-    buffer = weechat.info_get("irc_buffer", "%s,%s" % (
-        server_name, match.group(2)))
+    target = "%s/%s" % (server_name, dest)
+    targetl = target.lower()
 
     if targetl not in fish_keys:
-        fish_announce_unencrypted(buffer, target)
+        fish_announce_unencrypted(None, target)
 
         return string
 
-    if targetl not in fish_cyphers:
-        b = Blowfish(weechat.string_eval_expression(fish_keys[targetl], {}, {}, {}))
-        fish_cyphers[targetl] = b
-    else:
-        b = fish_cyphers[targetl]
-    if fish_cbc.get(targetl, False):
-        cbcKey = weechat.string_eval_expression(fish_keys[targetl], {}, {}, {})
-    else:
-        cbcKey = None
-    cypher = blowcrypt_pack(match.group(3).encode(), b, cbcKey)
+    cypher = blowcrypt_pack(
+            msg.encode(), fish_cypher(targetl), fish_cbc_key(targetl))
 
-    fish_announce_encrypted(buffer, target)
+    fish_announce_encrypted(None, target)
 
-    return "%s%s" % (match.group(1), cypher)
+    return "%s%s" % (prefix, cypher)
 
 
 def fish_modifier_out_topic_cb(data, modifier, server_name, string):
-    global fish_keys, fish_cyphers, fish_cbc
+    global fish_keys, fish_cbc
 
     if type(string) is bytes:
         return string
 
-    match = re.match(r"^(TOPIC (.*?) :)(.*)$", string)
+    match = _RE_OUT_TOPIC.match(string)
     if not match:
         return string
-    if not match.group(3):
+    prefix, dest, topic = match.groups()
+    if not topic:
         return string
 
-    target = "%s/%s" % (server_name, match.group(2))
-    targetl = ("%s/%s" % (server_name, match.group(2))).lower()
-    buffer = weechat.info_get("irc_buffer", "%s,%s" % (
-        server_name, match.group(2)))
+    target = "%s/%s" % (server_name, dest)
+    targetl = target.lower()
 
     if targetl not in fish_keys:
-        fish_announce_unencrypted(buffer, target)
+        fish_announce_unencrypted(None, target)
 
         return string
 
-    if targetl not in fish_cyphers:
-        b = Blowfish(weechat.string_eval_expression(fish_keys[targetl], {}, {}, {}))
-        fish_cyphers[targetl] = b
-    else:
-        b = fish_cyphers[targetl]
-    if fish_cbc.get(targetl, False):
-        cbcKey = weechat.string_eval_expression(fish_keys[targetl], {}, {}, {})
-    else:
-        cbcKey = None
-    cypher = blowcrypt_pack(match.group(3).encode(), b, cbcKey)
+    cypher = blowcrypt_pack(
+            topic.encode(), fish_cypher(targetl), fish_cbc_key(targetl))
 
-    fish_announce_encrypted(buffer, target)
+    fish_announce_encrypted(None, target)
 
-    return "%s%s" % (match.group(1), cypher)
+    return "%s%s" % (prefix, cypher)
 
 
 def fish_unload_cb():
@@ -919,8 +923,7 @@ def fish_cmd_blowkey(data, buffer, args):
             del fish_cbc[targetl]
         fish_keys[targetl] = argv2eol
 
-        if targetl in fish_cyphers:
-            del fish_cyphers[targetl]
+        fish_forget_key(targetl)
 
         if fish_cbc.get(targetl, False):
             cbcNote = " (cbc)"
@@ -940,8 +943,7 @@ def fish_cmd_blowkey(data, buffer, args):
 
         del fish_keys[targetl]
 
-        if targetl in fish_cyphers:
-            del fish_cyphers[targetl]
+        fish_forget_key(targetl)
 
         weechat.prnt(buffer, "removed key for %s" % target)
 
@@ -966,13 +968,95 @@ def fish_cmd_blowkey(data, buffer, args):
 # HELPERS
 #
 
+def fish_forget_key(targetl):
+    """Drops everything cached for the key of 'targetl'.  Must be called
+    whenever that key is set, changed or removed."""
+    global fish_cyphers, fish_keys_evaluated, fish_keys_encoded
+
+    fish_cyphers.pop(targetl, None)
+    fish_keys_evaluated.pop(targetl, None)
+    fish_keys_encoded.pop(targetl, None)
+
+
+def fish_eval_key(targetl):
+    """Returns the key of 'targetl' with ${...} expressions evaluated.  The
+    result is cached until the key is changed or removed."""
+    global fish_keys, fish_keys_evaluated
+
+    key = fish_keys_evaluated.get(targetl)
+    if key is None:
+        key = weechat.string_eval_expression(fish_keys[targetl], {}, {}, {})
+        fish_keys_evaluated[targetl] = key
+    return key
+
+
+def fish_cypher(targetl):
+    """Returns the ECB cipher for 'targetl', creating it on first use."""
+    global fish_cyphers
+
+    b = fish_cyphers.get(targetl)
+    if b is None:
+        b = Blowfish(fish_eval_key(targetl))
+        fish_cyphers[targetl] = b
+    return b
+
+
+def fish_decrypt(targetl, target, msg):
+    """Decrypts the '+OK '/'mcps ' payload 'msg' received from 'target' and
+    announces whether the conversation is encrypted.  Errors are re-raised
+    after announcing it as unencrypted."""
+    try:
+        clean = blowcrypt_unpack(
+                msg, fish_cypher(targetl), fish_encoded_key(targetl))
+    except Exception:
+        fish_announce_unencrypted(None, target)
+
+        raise
+
+    fish_announce_encrypted(None, target)
+
+    return clean
+
+
+def fish_encoded_key(targetl):
+    """Returns the evaluated key of 'targetl' encoded for the CBC ciphers.
+    Cached like fish_eval_key()."""
+    global fish_keys_encoded
+
+    key = fish_keys_encoded.get(targetl)
+    if key is None:
+        key = fish_eval_key(targetl).encode('utf-8')
+        fish_keys_encoded[targetl] = key
+    return key
+
+
+def fish_cbc_key(targetl):
+    """Returns the encoded key of 'targetl' if it uses CBC mode, otherwise
+    None."""
+    global fish_cbc
+
+    if not fish_cbc.get(targetl, False):
+        return None
+    return fish_encoded_key(targetl)
+
+
+def fish_target_buffer(target):
+    """Looks up the buffer of a 'server/nick' target.  Callbacks pass
+    buffer=None to the announce helpers so this WeeChat call only happens
+    when something is actually printed."""
+    return weechat.info_get("irc_buffer", "%s,%s" % tuple(
+            target.split("/", 1)))
+
+
 def fish_announce_encrypted(buffer, target):
-    global fish_encryption_announced, fish_config_option
+    global fish_encryption_announced, fish_announce_enabled
 
-    if (not weechat.config_boolean(fish_config_option['announce']) or
-            fish_encryption_announced.get(target)):
+    if not fish_announce_enabled or fish_encryption_announced.get(target):
         return
 
+    if buffer is None:
+        buffer = fish_target_buffer(target)
+
     (server, nick) = target.split("/")
 
     if (weechat.info_get("irc_is_nick", nick) and
@@ -989,12 +1073,14 @@ def fish_announce_encrypted(buffer, target):
 
 
 def fish_announce_unencrypted(buffer, target):
-    global fish_encryption_announced, fish_config_option
+    global fish_encryption_announced, fish_announce_enabled, fish_config_option
 
-    if (not weechat.config_boolean(fish_config_option['announce']) or
-            not fish_encryption_announced.get(target)):
+    if not fish_announce_enabled or not fish_encryption_announced.get(target):
         return
 
+    if buffer is None:
+        buffer = fish_target_buffer(target)
+
     fish_alert(buffer, "Messages to/from %s are %s*not*%s encrypted." % (
             target,
             weechat.color(weechat.config_color(fish_config_option["alert"])),
@@ -1070,4 +1156,4 @@ if (__name__ == "__main__" and import_ok and
 elif (__name__ == "__main__" and len(sys.argv) == 3):
     key = sys.argv[1]
     msg = sys.argv[2]
-    print(blowcrypt_unpack(msg, Blowfish(key), key))
+    print(blowcrypt_unpack(msg, Blowfish(key), key.encode('utf-8')))